@@ -2,8 +2,9 @@ import streamlit as st
 import pandas as pd
 import pdfplumber
 import fitz  # PyMuPDF
-from datetime import datetime, timedelta
+from datetime import date, datetime
 import re
+import string
 from io import BytesIO
 import traceback
 
@@ -14,93 +15,124 @@ st.set_page_config(
     layout="wide"
 )
 
+# Precompiled regex patterns used by the parsers
+_DATE_PATTERNS = (
+    r'\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})\b',  # MM/DD/YYYY or DD/MM/YYYY
+    r'\b(\d{4})[/.-](\d{1,2})[/.-](\d{1,2})\b',  # YYYY/MM/DD
+    r'\b(\d{1,2})\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\w*\s+(\d{4})\b',  # DD Month YYYY
+    r'\b(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\w*\s+(\d{1,2}),?\s+(\d{4})\b',  # Month DD, YYYY
+)
+# All date patterns as one alternation so the text is scanned in a single pass
+_COMBINED_DATE_RE = re.compile(
+    '|'.join(f'(?P<g{i}>{p})' for i, p in enumerate(_DATE_PATTERNS)),
+    re.IGNORECASE
+)
+_DATE_LINE_RE = re.compile(r'^\d+[/.-]\d+[/.-]\d+')
+_DOLLAR_RE = re.compile(r'\$\d+')
+_AMOUNT_RE = re.compile(r'\$?(\d+\.?\d*)')
+_LOCATION_CLEAN = re.compile(r'[^\w\s\-\.]')
+# Strips non-word ASCII punctuation (keeping '_' like \w) plus typographic
+# quotes and dashes common in PDF text
+_STRIP_PUNCT = str.maketrans('', '', string.punctuation.replace('_', '') + '‘’“”–—…•')
+# Common parking location indicators, matched anywhere in a line
+_LOC_KEYWORDS_RE = re.compile(
+    r'lot|garage|parking|meter|street|ave(?:nue)?|blvd|boulevard|rd|road',
+    re.IGNORECASE
+)
+
+# Month abbreviations used by the month-name date formats
+_MONTH_NAMES = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12
+}
+
+# Common words to exclude from client names
+_EXCLUDE_WORDS = frozenset({
+    'total', 'hours', 'time', 'date', 'project', 'task', 'work', 'report',
+    'summary', 'billing', 'invoice', 'amount', 'cost', 'rate', 'page',
+    'description', 'notes', 'client', 'company', 'contact', 'phone',
+    'email', 'address', 'city', 'state', 'zip', 'country'
+})
+
 def extract_text_from_pdf(uploaded_file):
-    """Extract text from PDF using pdfplumber with PyMuPDF fallback"""
+    """Extract text from an uploaded PDF, reusing cached results across reruns"""
+    return _extract_text_cached(uploaded_file.getvalue())
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _extract_text_cached(pdf_bytes):
+    """Extract text from PDF bytes using PyMuPDF with pdfplumber fallback"""
     try:
-        # First try with pdfplumber
-        with pdfplumber.open(uploaded_file) as pdf:
-            text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+        # First try with PyMuPDF, whose C-backed extractor is much faster
+        parts = []
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            for page in doc:
+                textpage = page.get_textpage()
+                parts.append(page.get_text("text", textpage=textpage))
+                textpage = None  # Release the page's text layout promptly
+        text = "\n".join(parts)
         
         if text.strip():
             return text
         else:
-            raise Exception("No text extracted with pdfplumber")
+            raise Exception("No text extracted with PyMuPDF")
             
     except Exception as e:
-        st.warning(f"pdfplumber failed: {str(e)}. Trying PyMuPDF...")
+        st.warning(f"PyMuPDF failed: {str(e)}. Trying pdfplumber...")
         
         try:
-            # Fallback to PyMuPDF
-            uploaded_file.seek(0)  # Reset file pointer
-            pdf_bytes = uploaded_file.read()
-            doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-            text = ""
-            for page_num in range(doc.page_count):
-                page = doc[page_num]
-                text += page.get_text() + "\n"
-            doc.close()
+            # Fallback to pdfplumber
+            with pdfplumber.open(BytesIO(pdf_bytes)) as pdf:
+                parts = []
+                for page in pdf.pages:
+                    page_text = page.extract_text()
+                    if page_text:
+                        parts.append(page_text)
+                text = "\n".join(parts)
             
             if text.strip():
                 return text
             else:
-                raise Exception("No text extracted with PyMuPDF")
+                raise Exception("No text extracted with pdfplumber")
                 
         except Exception as fallback_error:
-            st.error(f"Both PDF extraction methods failed. pdfplumber: {str(e)}, PyMuPDF: {str(fallback_error)}")
+            st.error(f"Both PDF extraction methods failed. PyMuPDF: {str(e)}, pdfplumber: {str(fallback_error)}")
             return None
 
+@st.cache_data(show_spinner=False, max_entries=32)
 def parse_dates_from_text(text):
     """Extract dates from text using various date patterns"""
-    dates = []
-    
-    # Common date patterns
-    date_patterns = [
-        r'\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})\b',  # MM/DD/YYYY or DD/MM/YYYY
-        r'\b(\d{4})[/.-](\d{1,2})[/.-](\d{1,2})\b',  # YYYY/MM/DD
-        r'\b(\d{1,2})\s+(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\w*\s+(\d{4})\b',  # DD Month YYYY
-        r'\b(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)\w*\s+(\d{1,2}),?\s+(\d{4})\b',  # Month DD, YYYY
-    ]
+    dates = set()
     
-    for pattern in date_patterns:
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
-            try:
-                groups = match.groups()
-                if len(groups) == 3:
-                    if groups[0].isdigit() and groups[1].isdigit() and groups[2].isdigit():
-                        # Numeric date
-                        if len(groups[0]) == 4:  # YYYY/MM/DD format
-                            date_obj = datetime.strptime(f"{groups[0]}-{groups[1]}-{groups[2]}", "%Y-%m-%d")
-                        else:  # MM/DD/YYYY or DD/MM/YYYY format - assume MM/DD/YYYY for US format
-                            date_obj = datetime.strptime(f"{groups[0]}/{groups[1]}/{groups[2]}", "%m/%d/%Y")
-                        dates.append(date_obj.date())
-                    else:
-                        # Month name format
-                        month_names = {
-                            'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
-                            'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12
-                        }
-                        if groups[1].lower()[:3] in month_names:
-                            month = month_names[groups[1].lower()[:3]]
-                            day = int(groups[0])
-                            year = int(groups[2])
-                            date_obj = datetime(year, month, day)
-                            dates.append(date_obj.date())
-                        elif groups[0].lower()[:3] in month_names:
-                            month = month_names[groups[0].lower()[:3]]
-                            day = int(groups[1])
-                            year = int(groups[2])
-                            date_obj = datetime(year, month, day)
-                            dates.append(date_obj.date())
-            except ValueError:
-                continue
+    for match in _COMBINED_DATE_RE.finditer(text):
+        try:
+            # lastindex is the outer g<i> group; its three date parts follow it
+            start = match.lastindex
+            groups = match.group(start + 1, start + 2, start + 3)
+            if groups[0].isdigit() and groups[1].isdigit() and groups[2].isdigit():
+                # Numeric date
+                if len(groups[0]) == 4:  # YYYY/MM/DD format
+                    date_obj = date(int(groups[0]), int(groups[1]), int(groups[2]))
+                else:  # MM/DD/YYYY or DD/MM/YYYY format - assume MM/DD/YYYY for US format
+                    date_obj = date(int(groups[2]), int(groups[0]), int(groups[1]))
+                dates.add(date_obj)
+            else:
+                # Month name format
+                if groups[1].lower()[:3] in _MONTH_NAMES:
+                    month = _MONTH_NAMES[groups[1].lower()[:3]]
+                    day = int(groups[0])
+                    year = int(groups[2])
+                    dates.add(date(year, month, day))
+                elif groups[0].lower()[:3] in _MONTH_NAMES:
+                    month = _MONTH_NAMES[groups[0].lower()[:3]]
+                    day = int(groups[1])
+                    year = int(groups[2])
+                    dates.add(date(year, month, day))
+        except ValueError:
+            continue
     
-    return list(set(dates))  # Remove duplicates
+    return sorted(dates)
 
+@st.cache_data(show_spinner=False, max_entries=32)
 def parse_parking_receipts(text):
     """Parse parking receipt data from text"""
     dates = parse_dates_from_text(text)
@@ -109,55 +141,46 @@ def parse_parking_receipts(text):
     locations = []
     lines = text.split('\n')
     
-    # Look for common parking location indicators
-    location_keywords = ['lot', 'garage', 'parking', 'meter', 'street', 'ave', 'avenue', 'blvd', 'boulevard', 'rd', 'road']
-    
     for line in lines:
-        line_lower = line.lower().strip()
-        if any(keyword in line_lower for keyword in location_keywords):
+        if _LOC_KEYWORDS_RE.search(line):
             # Clean up the line and add as potential location
-            cleaned_line = re.sub(r'[^\w\s\-\.]', ' ', line).strip()
+            cleaned_line = _LOCATION_CLEAN.sub(' ', line).strip()
             if len(cleaned_line) > 3:  # Avoid very short matches
                 locations.append(cleaned_line)
+                if len(locations) >= 10:  # Limit to first 10 locations found
+                    break
     
     # Extract amounts (optional, for future use)
     amounts = []
-    amount_pattern = r'\$?(\d+\.?\d*)'
-    amount_matches = re.findall(amount_pattern, text)
-    for amount in amount_matches:
+    for match in _AMOUNT_RE.finditer(text):
         try:
-            amounts.append(float(amount))
+            amounts.append(float(match.group(1)))
         except ValueError:
             continue
+        if len(amounts) >= 10:  # Limit to first 10 amounts found
+            break
     
     return {
         'dates': dates,
-        'locations': locations[:10],  # Limit to first 10 locations found
-        'amounts': amounts[:10]  # Limit to first 10 amounts found
+        'locations': locations,
+        'amounts': amounts
     }
 
+@st.cache_data(show_spinner=False, max_entries=32)
 def parse_time_report(text):
     """Parse time report data from text"""
     dates = parse_dates_from_text(text)
     
-    # Extract client names with better filtering
-    clients = []
+    # Extract client names with better filtering (dict used as an ordered set)
+    clients = {}
     lines = text.split('\n')
     
-    # Common words to exclude from client names
-    exclude_words = {
-        'total', 'hours', 'time', 'date', 'project', 'task', 'work', 'report',
-        'summary', 'billing', 'invoice', 'amount', 'cost', 'rate', 'page',
-        'description', 'notes', 'client', 'company', 'contact', 'phone',
-        'email', 'address', 'city', 'state', 'zip', 'country'
-    }
-    
     for line in lines:
         line = line.strip()
         # Skip lines that are too short, all digits, or contain dates
         if (len(line) < 3 or line.isdigit() or 
-            re.match(r'^\d+[/.-]\d+[/.-]\d+', line) or
-            re.search(r'\$\d+', line)):  # Skip lines with dollar amounts
+            _DATE_LINE_RE.match(line) or
+            _DOLLAR_RE.search(line)):  # Skip lines with dollar amounts
             continue
             
         # Look for lines with proper capitalization (likely company names)
@@ -165,64 +188,57 @@ def parse_time_report(text):
         potential_client = []
         
         for word in words:
-            clean_word = re.sub(r'[^\w]', '', word.lower())
-            if (len(word) > 1 and
-                (word.istitle() or word.isupper()) and
-                clean_word not in exclude_words and
-                not word.isdigit()):
-                potential_client.append(word)
+            # Cheap length and capitalization checks run before the lowercased copy
+            if len(word) < 2 or word.isdigit():
+                continue
+            if not (word.istitle() or word.isupper()):
+                continue
+            if word.lower().translate(_STRIP_PUNCT) in _EXCLUDE_WORDS:
+                continue
+            potential_client.append(word)
         
         if len(potential_client) >= 1:  # At least one proper noun
             client_name = ' '.join(potential_client)
             # Filter out very long strings (likely not client names)
             if 3 <= len(client_name) <= 50 and client_name not in clients:
-                clients.append(client_name)
+                clients[client_name] = None
     
     # Sort clients alphabetically and limit to reasonable number
-    clients = sorted(list(set(clients)))[:10]
+    clients = sorted(clients)[:10]
     
     return {
         'dates': dates,
         'clients': clients
     }
 
-def match_dates_to_clients(receipt_dates, time_report_data, client_address_mapping):
-    """Match receipt dates with work dates and assign clients"""
-    matches = []
+@st.cache_data(show_spinner=False, max_entries=32)
+def match_dates_to_clients(receipt_dates, time_dates, client_items):
+    """Match receipt dates with work dates and assign (client, address) pairs"""
+    if not receipt_dates or not time_dates or not client_items:
+        return pd.DataFrame(columns=['date', 'client', 'address', 'match_type'])
     
-    for receipt_date in receipt_dates:
-        best_matches = []
-        
-        # Look for exact date matches first
-        if receipt_date in time_report_data['dates']:
-            for client in time_report_data['clients']:
-                if client in client_address_mapping:
-                    best_matches.append({
-                        'date': receipt_date,
-                        'client': client,
-                        'address': client_address_mapping[client],
-                        'match_type': 'exact'
-                    })
-        
-        # If no exact match, look for dates within ±1 day
-        if not best_matches:
-            for time_date in time_report_data['dates']:
-                date_diff = abs((receipt_date - time_date).days)
-                if date_diff <= 1:
-                    for client in time_report_data['clients']:
-                        if client in client_address_mapping:
-                            best_matches.append({
-                                'date': receipt_date,
-                                'client': client,
-                                'address': client_address_mapping[client],
-                                'match_type': f'±{date_diff} day(s)'
-                            })
-        
-        # Only add matches if we found valid ones (skip unmatched entries)
-        if best_matches:
-            matches.extend(best_matches)
+    # As-of join each receipt date to the nearest work date within ±1 day
+    receipts_df = pd.DataFrame({'date': pd.to_datetime(sorted(set(receipt_dates)))})
+    work_dates = pd.to_datetime(sorted(set(time_dates)))
+    work_df = pd.DataFrame({'date': work_dates, 'time_date': work_dates})
+    merged = pd.merge_asof(
+        receipts_df, work_df, on='date',
+        tolerance=pd.Timedelta('1D'), direction='nearest'
+    )
+    
+    # Only keep receipts with a matching work date (skip unmatched entries)
+    merged = merged.dropna(subset=['time_date'])
+    merged['match_type'] = 'exact'
+    merged.loc[merged['date'] != merged['time_date'], 'match_type'] = '±1 day(s)'
+    merged['date'] = merged['date'].dt.date
+    
+    clients_df = pd.DataFrame({
+        'client': [client for client, _ in client_items],
+        'address': [address for _, address in client_items]
+    })
+    matches = merged[['date', 'match_type']].merge(clients_df, how='cross')
     
-    return matches
+    return matches[['date', 'client', 'address', 'match_type']].reset_index(drop=True)
 
 def main():
     st.title("🚗 Mileage Reimbursement Calculator")
@@ -259,14 +275,17 @@ def main():
     
     if uploaded_receipts:
         with st.spinner("Processing parking receipts..."):
-            all_receipt_data = {'dates': [], 'locations': [], 'amounts': []}
+            all_receipt_data = {'dates': set(), 'locations': [], 'amounts': []}
             
+            # Files are processed one at a time: PyMuPDF is not thread-safe and
+            # holds the GIL while extracting, so a thread pool would not help.
+            # Repeat uploads are served from the extraction cache instead.
             for receipt_file in uploaded_receipts:
                 try:
                     text = extract_text_from_pdf(receipt_file)
                     if text:
                         receipt_data = parse_parking_receipts(text)
-                        all_receipt_data['dates'].extend(receipt_data['dates'])
+                        all_receipt_data['dates'].update(receipt_data['dates'])
                         all_receipt_data['locations'].extend(receipt_data['locations'])
                         all_receipt_data['amounts'].extend(receipt_data['amounts'])
                         st.success(f"✓ Processed {receipt_file.name}")
@@ -276,7 +295,7 @@ def main():
                     st.error(f"✗ Error processing {receipt_file.name}: {str(e)}")
             
             # Remove duplicates and sort
-            all_receipt_data['dates'] = sorted(list(set(all_receipt_data['dates'])))
+            all_receipt_data['dates'] = sorted(all_receipt_data['dates'])
             all_receipt_data['locations'] = list(set(all_receipt_data['locations']))
             
             st.session_state.receipt_data = all_receipt_data
@@ -322,7 +341,7 @@ def main():
             
             with st.expander("View extracted work dates"):
                 st.write("**Work dates found:**")
-                for date in sorted(st.session_state.time_report_data['dates']):
+                for date in st.session_state.time_report_data['dates']:
                     st.write(f"- {date.strftime('%B %d, %Y')}")
     
     # Section 3: Add Your Clients and Addresses
@@ -410,10 +429,15 @@ def main():
         
         if st.button("Generate Matches", type="primary"):
             with st.spinner("Matching receipt dates with work dates..."):
+                mapping = st.session_state.client_address_mapping
                 matches = match_dates_to_clients(
-                    st.session_state.receipt_data['dates'],
-                    st.session_state.time_report_data,
-                    st.session_state.client_address_mapping
+                    tuple(st.session_state.receipt_data['dates']),
+                    tuple(st.session_state.time_report_data['dates']),
+                    tuple(
+                        (client, mapping[client])
+                        for client in st.session_state.time_report_data['clients']
+                        if client in mapping
+                    )
                 )
                 
                 st.session_state.matches = matches
@@ -427,7 +451,7 @@ def main():
                 st.info(f"Note: {total_receipts - matched_receipts} parking receipts had no matching work dates and are excluded from the summary.")
             
             # Display matches in a table
-            matches_df = pd.DataFrame(st.session_state.matches)
+            matches_df = st.session_state.matches
             
             if not matches_df.empty:
                 st.dataframe(
@@ -445,11 +469,11 @@ def main():
                 col1, col2, col3 = st.columns(3)
                 
                 with col1:
-                    exact_matches = len([m for m in st.session_state.matches if m['match_type'] == 'exact'])
+                    exact_matches = int((matches_df['match_type'] == 'exact').sum())
                     st.metric("Exact Matches", exact_matches)
                 
                 with col2:
-                    near_matches = len([m for m in st.session_state.matches if '±' in m['match_type']])
+                    near_matches = int(matches_df['match_type'].str.contains('±').sum())
                     st.metric("Near Matches (±1 day)", near_matches)
                 
                 with col3:
@@ -461,23 +485,19 @@ def main():
                 # Section 5: Download CSV
                 st.header("📥 Step 5: Download Report")
                 
-                # Prepare CSV data
-                csv_data = matches_df.copy()
-                csv_data['date'] = csv_data['date'].astype(str)
-                
-                # Add metadata
-                csv_data['generated_on'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                csv_data['total_entries'] = len(csv_data)
-                
-                # Convert to CSV
-                csv_buffer = BytesIO()
-                csv_data.to_csv(csv_buffer, index=False)
-                csv_buffer.seek(0)
+                # Convert to CSV, with the metadata in a single header comment
+                # line rather than repeated on every row
+                generated_on = datetime.now()
+                csv_header = (
+                    f"# generated_on={generated_on.strftime('%Y-%m-%d %H:%M:%S')} "
+                    f"total_entries={len(matches_df)}\n"
+                )
+                csv_bytes = (csv_header + matches_df.to_csv(index=False)).encode('utf-8')
                 
                 st.download_button(
                     label="📊 Download CSV Report",
-                    data=csv_buffer.getvalue(),
-                    file_name=f"mileage_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    data=csv_bytes,
+                    file_name=f"mileage_report_{generated_on.strftime('%Y%m%d_%H%M%S')}.csv",
                     mime="text/csv",
                     type="primary"
                 )